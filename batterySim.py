@@ -1,19 +1,57 @@
 #!/usr/bin/env python3
-import sys, math
+import sys, math, array, time, asyncio, atexit, queue
+import numpy as np
 from textwrap import dedent
 import caproto
 from caproto import ChannelType
 from caproto.server import PVGroup, ioc_arg_parser, pvproperty, run
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-# Configure logging to display INFO level messages
-logging.basicConfig(filename='batterySim.log', level=logging.INFO)
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Fallback when numba is not installed: run the decorated function as plain Python."""
+        return lambda func: func
+
+# Configure logging to record INFO level messages in a size-capped, rotating log file.
+# Records are handed over through a queue and written by a background thread, so file I/O never blocks the event loop.
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+_log_file_handler = RotatingFileHandler('batterySim.log', maxBytes=1_048_576, backupCount=3)
+_log_file_handler.setLevel(logging.INFO)
+_log_file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _log_file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # Global constants
 seconds_per_hour = 3600
 hours_per_second = 1 / seconds_per_hour
 
+@njit(cache=True)
+def _sim_step(E, E_target, V, target_V, I, charging_power, dE, bn):
+    """
+    Advance the battery state E = exp(V/Vn) at a constant charging power.
+    dE is the change of E per Watt of charging power over the step.
+    Returns the new (E, V, I) and whether the battery was charged or discharged.
+    """
+    if (charging_power > 0 and E < E_target):
+        # charging the battery
+        I = 0.0
+        E = min(E + charging_power * dE, E_target)
+    elif (charging_power < 0):
+        # discharging the battery
+        I = charging_power / V
+        E = max(E + charging_power * dE, 1.0)
+    else:
+        return E, V, I, False
+    V = target_V if (E == E_target) else bn * math.log(E)
+    return E, V, I, True
+
 class BatteryChargeIOC(PVGroup):
     """
     An IOC with read/writable PVs.
@@ -41,6 +79,7 @@ class BatteryChargeIOC(PVGroup):
     V_real  = pvproperty(
         name='Vreal',
         value=34.02,
+        dtype=ChannelType.FLOAT,
         doc='real battery voltage',
         units='Volts',
         precision=2,
@@ -50,6 +89,7 @@ class BatteryChargeIOC(PVGroup):
     I_real  = pvproperty(
         name='Ireal',
         value=-0.24,
+        dtype=ChannelType.FLOAT,
         doc='real battery current',
         units='Amps',
         precision=2,
@@ -59,6 +99,7 @@ class BatteryChargeIOC(PVGroup):
     V_sim  = pvproperty(
         name='Vsim',
         value=32.0,
+        dtype=ChannelType.FLOAT,
         doc='simulated battery voltage',
         units='Volts',
         precision=2,
@@ -68,6 +109,7 @@ class BatteryChargeIOC(PVGroup):
     I_sim = pvproperty(
         name='Isim',
         value=0.0,
+        dtype=ChannelType.FLOAT,
         doc='simulated battery current',
         units='Amps',
         precision=2,
@@ -77,6 +119,7 @@ class BatteryChargeIOC(PVGroup):
     V_target = pvproperty(
         name='Vtarget',
         value=34.0,
+        dtype=ChannelType.FLOAT,
         doc='target battery voltage',
         units='Volts',
         precision=2,
@@ -86,6 +129,7 @@ class BatteryChargeIOC(PVGroup):
     Solar_power = pvproperty(
         name='SolarPower',
         value=110.0,
+        dtype=ChannelType.FLOAT,
         doc='Power from solar panel',
         units='Watts',
         precision=2,
@@ -105,114 +149,191 @@ class BatteryChargeIOC(PVGroup):
         super().__init__(*args, **kwargs)
         self.initOK = True
         # set initial values
-        self.sim_time = 0.0   # seconds
+        self.sim_interval = 1    # seconds
+        self.publish_every = 10    # simulation ticks per PV update
         self.eclipse_half_duration = 3600   # seconds
+        self._ecl_profile = None    # solar power for each tick of the current eclipse
+        self._ecl_idx = 0
         self.init_solar_power = self.Solar_power.value
-        logger.info(f"=== Creating the Simulator ===")
-        logger.info(f"This battery allows maximum voltage: Vmax = {self.max_voltage}")
+        self._max_voltage = self.max_voltage
+        # lookup table of exp(V/Vn) over [0, Vmax], linearly interpolated in the simulation loop
+        self._exp_tab = array.array('d', [math.exp(i * self.max_voltage / 1023 / self.battery_nominal_voltage) for i in range(1024)])
+        self._exp_scale = 1023.0 / self.max_voltage
+        # compile the simulation kernel now instead of during the first batch on the event loop (no-op without numba)
+        _sim_step(1.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, self.battery_nominal_voltage)
+        # accepted Eclipse values (enum strings and 0/1, which also match 0.0/1.0) and the state transitions
+        self._ecl_map = {s: i for i, s in enumerate(self.Eclipse.enum_strings)}
+        self._ecl_map.update({0: 0, 1: 1})
+        self._ecl_transitions = {(0, 1): self._enter_eclipse, (1, 0): self._leave_eclipse}
+        logger.info("=== Creating the Simulator ===")
+        logger.info("This battery allows maximum voltage: Vmax = %s", self.max_voltage)
 
         # check if default values are set correctly
         if (self.V_sim.value < 0 or self.V_sim.value > self.max_voltage):
-            logger.critical(f"Default battery voltage {self.V_sim.value} is out of the allowed range [0, {self.max_voltage}]")
+            logger.critical("Default battery voltage %s is out of the allowed range [0, %s]", self.V_sim.value, self.max_voltage)
             self.initOK = False
             return
         if (self.Solar_power.value < 0 or self.Solar_power.value > self.solar_power_max):
-            logger.critical(f"Default solar power {self.Solar_power.value} is out of the allowed range [0, {self.solar_power_max}]")
+            logger.critical("Default solar power %s is out of the allowed range [0, %s]", self.Solar_power.value, self.solar_power_max)
             self.initOK = False
             return
         if (self.V_target.value < 0 or self.V_target.value > self.max_voltage):
-            logger.critical(f"Default target voltage {self.V_target.value} is out of the allowed range [0, {self.max_voltage}]")
+            logger.critical("Default target voltage %s is out of the allowed range [0, %s]", self.V_target.value, self.max_voltage)
             self.initOK = False
             return
         if (self.Eclipse.value == 1):
-            self.eclipse_begin = self.sim_time
+            self._start_eclipse()
+
+    def _start_eclipse(self):
+        """Precompute the solar power profile of an eclipse, one value per simulation tick."""
+        N = self.eclipse_half_duration // self.sim_interval
+        tmp = np.arange(1, 2 * N + 1) / N
+        # cos(0.5*pi*tmp) going into the eclipse, -cos(0.5*pi*tmp) coming out of it
+        self._ecl_profile = self.init_solar_power * np.abs(np.cos(0.5 * np.pi * tmp))
+        self._ecl_idx = 0
+
+    def _exp_v(self, V):
+        """exp(V/Vn) from the lookup table, falling back to math.exp outside [0, Vmax]."""
+        idx_f = V * self._exp_scale
+        if (not (0 <= idx_f < 1023)):    # also catches NaN
+            return math.exp(V / self.battery_nominal_voltage)
+        tab = self._exp_tab
+        i = int(idx_f)
+        return tab[i] + (idx_f - i) * (tab[i + 1] - tab[i])
+
+    async def _wait_next_batch(self, sleep, next_deadline, period):
+        """
+        Sleep until the next batch deadline on the monotonic clock, so jitter does not accumulate.
+        Returns the deadline that was waited for.
+        """
+        next_deadline += period
+        delay = next_deadline - time.monotonic()
+        if (delay > 0):
+            await sleep(delay)
+        else:
+            # running behind: drop the missed deadlines instead of bursting to catch up
+            if (delay < -period):
+                next_deadline = time.monotonic()
+            await sleep(0)
+        return next_deadline
 
     @V_sim.startup
     async def V_sim(self, instance, async_lib):
-        """Startup method for V_sim PV. Runs the main simulation loop."""
+        """
+        Startup method for V_sim PV. Runs the main simulation loop.
+
+        The model Energy = model_constant * (exp(V/Vn) - 1) gives d(exp(V/Vn))/dt = charging_power / model_constant,
+        so the loop keeps E = exp(V/Vn) as its state and advances it by plain additions.
+        V_sim = Vn * log(E) is only evaluated when publishing.
+        """
         logger.info("== Simulation loop started ==")
 
         # simulation parameters
-        sim_interval = 1    # senconds
+        sim_interval = self.sim_interval    # seconds
         deltaT = sim_interval * hours_per_second    # hours
+        publish_every = self.publish_every
+        # bind PVs, constants and math functions once, outside the loop
+        v_sim_pv = self.V_sim
+        i_sim_pv = self.I_sim
+        vtarget_pv = self.V_target
+        sp_pv = self.Solar_power
+        _sleep = async_lib.library.sleep
+        exp_v = self._exp_v
+        bn = self.battery_nominal_voltage
+        lp = self.load_power_const
+        dE_batch = publish_every * deltaT / self.model_constant    # change of exp(V/Vn) per batch per Watt of charging power
+
+        # simulation state: E = exp(V_sim/Vn), and the V_sim value last published
+        E = 1.0
+        published_V = None
+
+        period = 0.1 * sim_interval * publish_every    # wall-clock seconds per batch
+        next_deadline = time.monotonic()
         while True:
-            # get current PV values
-            Vsim_value = self.V_sim.value
-            target_V = self.V_target.value
-            sp_value = self.Solar_power.value
-            charging_power = sp_value - self.load_power_const
-
-            # update V_sim and I_sim
-            if (charging_power > 0 and Vsim_value < target_V):
-                # charging the battery
-                tmp = math.exp(Vsim_value / self.battery_nominal_voltage)
-                deltaV = charging_power * deltaT * self.battery_nominal_voltage / (self.model_constant * tmp)
-                Vsim_value += deltaV
-                Vsim_value = min(Vsim_value, target_V)
-                await self.V_sim.write(Vsim_value)
-                await self.I_sim.write(0.0)
-            elif (charging_power < 0):
-                # discharging the battery
-                Isim_value = charging_power / Vsim_value
-                tmp = math.exp(Vsim_value / self.battery_nominal_voltage)
-                deltaV = charging_power * deltaT * self.battery_nominal_voltage / (self.model_constant * tmp)
-                Vsim_value += deltaV
-                Vsim_value = max(Vsim_value, 0)
-                await self.V_sim.write(Vsim_value)
-                await self.I_sim.write(Isim_value)
-
-            #update Solar_power
-            if(self.Eclipse.value == 1):
-                tmp = (self.sim_time - self.eclipse_begin) / self.eclipse_half_duration
-                if (tmp > 0 and tmp <=1):
-                    solar_power = self.init_solar_power * math.cos(0.5 * math.pi * tmp)
-                    await self.Solar_power.write(solar_power)
-                elif (tmp > 1 and tmp <= 2):
-                    solar_power = - self.init_solar_power * math.cos(0.5 * math.pi * tmp)
-                    await self.Solar_power.write(solar_power)
-                elif (tmp > 2):
-                    await self.Eclipse.write(0)
-
-            # next step
-            self.sim_time += sim_interval
-            await async_lib.library.sleep(0.1 * sim_interval)
+            # get current PV values; client puts to these FLOAT PVs are stored as np.float32,
+            # so coerce them to keep the state and the _sim_step kernel in double precision
+            Vsim_value = float(v_sim_pv.value)
+            Isim_current = float(i_sim_pv.value)
+            target_V = float(vtarget_pv.value)
+            sp_value = float(sp_pv.value)
+
+            # resync the state if V_sim was written from outside the loop
+            if (Vsim_value != published_V):
+                E = exp_v(Vsim_value)
+                published_V = Vsim_value
+            E_target = exp_v(target_V)
+
+            # solar power is held for the whole batch, so advance it in one step
+            E, Vsim_value, Isim_value, updated = _sim_step(
+                E, E_target, Vsim_value, target_V, Isim_current, sp_value - lp, dE_batch, bn)
+
+            # publish the state at the end of the batch
+            if (updated):
+                # skip writes clients cannot see (precision=2), but always publish a clamped final value
+                if (Vsim_value != published_V and
+                        (abs(Vsim_value - published_V) >= 0.005 or E == E_target or E == 1.0)):
+                    published_V = Vsim_value
+                    await v_sim_pv.write(Vsim_value)
+                # compare against the PV itself, so a value put by a client is still overwritten
+                if (Isim_value != Isim_current):
+                    await i_sim_pv.write(Isim_value)
+
+            next_deadline = await self._wait_next_batch(_sleep, next_deadline, period)
+
+    @Solar_power.startup
+    async def Solar_power(self, instance, async_lib):
+        """Startup method for Solar_power PV. Follows the solar power profile while in eclipse."""
+        ecl_pv = self.Eclipse
+        _sleep = async_lib.library.sleep
+        publish_every = self.publish_every
+        period = 0.1 * self.sim_interval * publish_every    # wall-clock seconds per batch
+        next_deadline = time.monotonic()
+        while True:
+            ecl_profile = self._ecl_profile
+            if (ecl_profile is not None):
+                ecl_idx = self._ecl_idx + publish_every
+                self._ecl_idx = ecl_idx
+                if (ecl_idx <= len(ecl_profile)):
+                    await instance.write(float(ecl_profile[ecl_idx - 1]))
+                else:
+                    await ecl_pv.write(0)
+
+            next_deadline = await self._wait_next_batch(_sleep, next_deadline, period)
 
     @V_target.putter
     async def V_target(self, instance, value):
         """Set target voltage for charging, value range [0 Vmax] Volts"""
-        logger.info(f"Setting V_target(target voltage): requested={value}, current={instance.value}")
-        new_value = max(0.0, min(value, self.max_voltage))
-        logger.info(f"V_target set to {new_value}")
+        logger.info("Setting V_target(target voltage): requested=%s, current=%s", value, instance.value)
+        new_value = value
+        if (not new_value >= 0.0):    # also maps NaN to 0, as max(0.0, min(...)) did
+            new_value = 0.0
+        elif (new_value > self._max_voltage):
+            new_value = self._max_voltage
+        logger.info("V_target set to %s", new_value)
         return new_value
 
+    async def _enter_eclipse(self):
+        """Eclipse 0 -> 1: start following the eclipse solar power profile."""
+        logger.info("== Going into eclipse. ==")
+        self._start_eclipse()
+
+    async def _leave_eclipse(self):
+        """Eclipse 1 -> 0: drop the eclipse profile and restore the initial solar power."""
+        logger.info("== Reset to non-eclipse. ==")
+        self._ecl_profile = None
+        await self.Solar_power.write(self.init_solar_power)
+
     @Eclipse.putter
     async def Eclipse(self, instance, value):
         """Handle writes to Eclipse PV, changing eclipse status."""
-        if isinstance(value, str):
-            enum_strings = self.Eclipse.enum_strings
-            try:
-                new_value = enum_strings.index(value)
-                if(new_value == 1 and instance.value == 0):
-                    logger.info("== Going into eclipse. ==")
-                    self.eclipse_begin = self.sim_time
-                elif(new_value == 0 and instance.value == 1):
-                    logger.info("== Reset to non-eclipse. ==")
-                    await self.Solar_power.write(self.init_solar_power)
-                return new_value
-            except ValueError:
-                logger.info(f"Invalid State string '{value}', reverting to {instance.value}")
-                return instance.value
-        elif isinstance(value, (int, float)) and int(value) in range(2):
-            if(int(value) == 1 and instance.value == 0):
-                logger.info("== Going into eclipse. ==")
-                self.eclipse_begin = self.sim_time
-            elif(int(value) == 0 and instance.value == 1):
-                logger.info("== Reset to non-eclipse. ==")
-                await self.Solar_power.write(self.init_solar_power)
-            return int(value)
-        else:
-            logger.info(f"Invalid State '{value}', reverting to {instance.value}")
-        return instance.value
+        new_value = self._ecl_map.get(value)
+        if (new_value is None):
+            logger.info("Invalid State '%s', reverting to %s", value, instance.value)
+            return instance.value
+        transition = self._ecl_transitions.get((instance.value, new_value))
+        if (transition is not None):
+            await transition()
+        return new_value
 
 
 if __name__ == '__main__':
@@ -224,4 +345,11 @@ if __name__ == '__main__':
         print("Initialization failed!")
         logger.critical("Initialization failed!")
         sys.exit(1)
+    if (run_options.get('module_name') == 'caproto.asyncio.server'):
+        # use the faster uvloop event loop with the asyncio backend, when available
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
     run(ioc.pvdb, **run_options)